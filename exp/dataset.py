@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+import os.path as osp
+import pickle
+import torch
+from torch_geometric.data.separate import separate
+from ogb.graphproppred import PygGraphPropPredDataset
+
+# Graphs and pre_transform used by the pre_transform workers, inherited by the forked worker processes
+_pre_transform_state = {}
+
+
+def _apply_pre_transform(idx):
+    data_list, pre_transform, seed = _pre_transform_state['data_list'], _pre_transform_state['pre_transform'], \
+        _pre_transform_state['seed']
+    # Seed per graph so the (random) expander graph generation doesn't depend on the number of workers
+    torch.manual_seed(seed + idx)
+    # Clone, as the graph's tensors are views into the storage of the whole collated dataset
+    return pre_transform(data_list[idx].clone())
+
+
+def _apply_pre_transform_and_serialise(idx):
+    # Serialise with the standard pickle, as torch's multiprocessing pickler moves every tensor into shared memory and
+    # keeps a file descriptor open for each of them
+    return pickle.dumps(_apply_pre_transform(idx))
+
+
+class CachedPygGraphPropPredDataset(PygGraphPropPredDataset):
+    """
+    PygGraphPropPredDataset which stores its processed files in a directory specific to 'variant'. PyG only processes
+    the raw data when no processed files exist, and otherwise reuses them even if they were created with a different
+    'pre_transform'. Giving every pre_transform configuration its own variant lets the (expensive) pre_transform run
+    once per configuration, while the raw data is shared between all of them. The pre_transform is applied in parallel
+    over 'num_workers' processes, with a random state derived from 'seed' for every graph, so the processed files of a
+    variant are the same whichever run creates them.
+    """
+
+    def __init__(self, name, variant=None, root='dataset', transform=None, pre_transform=None, meta_dict=None,
+                 num_workers=None, seed=0):
+        '''
+            name (str): name of the OGB dataset
+            variant (str): name of the processed data variant. Uses the default processed directory if None.
+            num_workers (int): number of processes applying the pre_transform (default: number of CPUs)
+            seed (int): seed of the random state of the pre_transform (default: 0)
+        '''
+        self.variant = variant
+        self.seed = seed
+        self._collating_raw = False
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        super(CachedPygGraphPropPredDataset, self).__init__(name=name, root=root, transform=transform,
+                                                            pre_transform=pre_transform, meta_dict=meta_dict)
+
+    @property
+    def processed_dir(self):
+        if self.variant is None:
+            return super(CachedPygGraphPropPredDataset, self).processed_dir
+        return osp.join(self.root, f'processed_{self.variant}')
+
+    @property
+    def processed_file_names(self):
+        # The graphs without the pre_transform are saved under a temporary name, so an interrupted run doesn't leave
+        # them behind as the processed dataset
+        if self._collating_raw:
+            return 'geometric_data_raw.pt.tmp'
+        return super(CachedPygGraphPropPredDataset, self).processed_file_names
+
+    # PyG only downloads/processes datasets whose class defines these methods itself
+    def download(self):
+        super(CachedPygGraphPropPredDataset, self).download()
+
+    def process(self):
+        # Let OGB read and collate the raw graphs without the pre_transform, which is then applied in parallel
+        pre_transform, self.pre_transform = self.pre_transform, None
+        self._collating_raw = pre_transform is not None
+        try:
+            super(CachedPygGraphPropPredDataset, self).process()
+            raw_collated_path = self.processed_paths[0]
+        finally:
+            self.pre_transform = pre_transform
+            self._collating_raw = False
+        if pre_transform is None:
+            return
+
+        data, slices = torch.load(raw_collated_path)
+        os.remove(raw_collated_path)
+        num_graphs = next(iter(slices.values())).numel() - 1
+        data_list = [separate(cls=data.__class__, batch=data, idx=idx, slice_dict=slices, decrement=False)
+                     for idx in range(num_graphs)]
+
+        _pre_transform_state.update(data_list=data_list, pre_transform=pre_transform, seed=self.seed)
+        try:
+            if self.num_workers > 1:
+                with multiprocessing.get_context('fork').Pool(self.num_workers) as pool:
+                    data_list = [pickle.loads(serialised_data) for serialised_data in
+                                 pool.imap(_apply_pre_transform_and_serialise, range(num_graphs), chunksize=64)]
+            else:
+                # The per graph seeding would otherwise replace the caller's random state
+                with torch.random.fork_rng(devices=[]):
+                    data_list = [_apply_pre_transform(idx) for idx in range(num_graphs)]
+        finally:
+            _pre_transform_state.clear()
+
+        data, slices = self.collate(data_list)
+        print('Saving...')
+        # Written to a temporary file first, so the processed file only exists once it is complete
+        torch.save((data, slices), self.processed_paths[0] + '.tmp')
+        os.replace(self.processed_paths[0] + '.tmp', self.processed_paths[0])
+
+
+def add_graph_attr(dataset, key, value):
+    '''
+        Adds the graph level attribute 'key' to every graph of the in-memory 'dataset', where value[i] is the attribute
+        of graph i. Unlike a pre_transform this doesn't require reprocessing the dataset, so it suits attributes which
+        are cheap to compute but depend on the run's configuration.
+    '''
+    data = dataset._data if hasattr(dataset, '_data') else dataset.data
+    assert value.shape[0] == dataset.slices[next(iter(dataset.slices))].numel() - 1
+    data[key] = value
+    dataset.slices[key] = torch.arange(value.shape[0] + 1)
+    # Graphs already separated from the collated data don't have the attribute
+    dataset._data_list = None
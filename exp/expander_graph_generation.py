@@ -68,6 +68,8 @@ def add_expander_edges_via_perfect_matchings(hypergraph_order: int,
     zeros = torch.zeros(num_nodes)
     expander_node_mask = torch.concat((ones, zeros))
     new_data['expander_edge_index'] = expander_edge_index
+    # Reversed edges for the right -> left propagation, so they are not recomputed in every forward pass
+    new_data['expander_edge_index_rev'] = expander_edge_index[[1, 0]].contiguous()
     new_data['expander_node_mask'] = expander_node_mask
     new_data['x'] = expander_graph_x
     new_data['num_nodes'] = new_num_nodes
@@ -160,6 +162,7 @@ def add_expander_edges_via_ramanujan_bipartite_graph(hypergraph_order: int,
     zeros = torch.zeros(num_nodes)
     expander_node_mask = torch.concat((ones, zeros))
     new_data['expander_edge_index'] = expander_edge_index
+    new_data['expander_edge_index_rev'] = expander_edge_index[[1, 0]].contiguous()
     new_data['expander_node_mask'] = expander_node_mask
     new_data['x'] = expander_graph_x
     new_data['num_nodes'] = new_num_nodes
@@ -275,6 +278,7 @@ def add_expander_edges_via_perfect_matchings_shortest_paths_heuristics(hypergrap
     zeros = torch.zeros(num_nodes)
     expander_node_mask = torch.concat((ones, zeros))
     new_data['expander_edge_index'] = expander_edge_index
+    new_data['expander_edge_index_rev'] = expander_edge_index[[1, 0]].contiguous()
     new_data['expander_node_mask'] = expander_node_mask
     new_data['x'] = expander_graph_x
     new_data['num_nodes'] = new_num_nodes
@@ -419,6 +423,7 @@ def add_expander_edges_via_perfect_matchings_access_time_heuristics(hypergraph_o
     zeros = torch.zeros(num_nodes)
     expander_node_mask = torch.concat((ones, zeros))
     new_data['expander_edge_index'] = expander_edge_index
+    new_data['expander_edge_index_rev'] = expander_edge_index[[1, 0]].contiguous()
     new_data['expander_node_mask'] = expander_node_mask
     new_data['x'] = expander_graph_x
     new_data['num_nodes'] = new_num_nodes
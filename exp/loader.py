@@ -0,0 +1,47 @@
+import torch
+
+
+class CUDAPrefetchLoader(object):
+    """
+    Wraps a DataLoader and copies each batch to the GPU on a side CUDA stream, so the copy of the next batch overlaps
+    with the computation on the current one. The wrapped loader should use pinned memory, otherwise the copies are not
+    asynchronous. On other devices the batches are copied as they are read.
+    """
+
+    def __init__(self, loader, device):
+        '''
+            loader (DataLoader): loader of PyG batches
+            device (torch.device): device the batches are copied to
+        '''
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != 'cuda':
+            for batch in self.loader:
+                yield batch.to(self.device)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        prefetched = None
+        for batch in self.loader:
+            with torch.cuda.stream(stream):
+                batch = batch.to(self.device, non_blocking=True)
+                copied = torch.cuda.Event()
+                copied.record(stream)
+            if prefetched is not None:
+                yield self._wait(*prefetched)
+            prefetched = (batch, copied)
+        if prefetched is not None:
+            yield self._wait(*prefetched)
+
+    def _wait(self, batch, copied):
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_event(copied)
+        # The batch's memory was allocated on the side stream, so mark it as in use by the current stream to stop the
+        # caching allocator from reusing it while the current stream may still read it
+        batch.apply_(lambda x: x.record_stream(current_stream))
+        return batch
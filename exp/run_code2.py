@@ -1,11 +1,19 @@
+import datetime
 import functools
+import json
 import logging
 import torch
+import torch.distributed as dist
 from torch_geometric.loader import DataLoader
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 from models.gnn import GNN
 from exp import expander_graph_generation
+from exp.dataset import CachedPygGraphPropPredDataset, add_graph_attr
+from exp.loader import CUDAPrefetchLoader
+from exp.utils import get_loader_kwargs, supports_compile, compile_model, get_amp, get_profiler
 
 from tqdm import tqdm
 import argparse
@@ -14,63 +22,76 @@ import pandas as pd
 import os
 
 ### importing OGB
-from ogb.graphproppred import PygGraphPropPredDataset, Evaluator
+from ogb.graphproppred import Evaluator
 
 ### importing utils
-from models.utils import ASTNodeEncoder, get_vocab_mapping, str2bool, set_seed
+from models.utils import ASTNodeEncoder, get_vocab_mapping, str2bool, set_seed, set_backend_flags
 ### for data transform
-from models.utils import augment_edge, encode_y_to_arr, decode_arr_to_seq
+from models.utils import augment_edge, encode_seq_to_arr, decode_mat_to_seqs
 
 multicls_criterion = torch.nn.CrossEntropyLoss()
 
 
-def train(model, device, loader, optimizer):
+def train(model, device, loader, optimizer, scaler, amp_dtype=None, accum_steps=1, profiler=None):
     model.train()
 
-    loss_accum = 0
-    for step, batch in enumerate(tqdm(loader, desc="Iteration")):
-        batch = batch.to(device)
+    optimizer.zero_grad(set_to_none=True)
+    num_accumulated = 0
+    # Accumulate on the device so the loss is only synchronised to the host once per epoch
+    loss_accum = torch.zeros((), device=device)
+    for step, batch in enumerate(tqdm(CUDAPrefetchLoader(loader, device), desc="Iteration")):
 
         if batch.x.shape[0] == 1 or batch.batch[-1] == 0:
             pass
         else:
-            pred_list = model(batch)
-            optimizer.zero_grad()
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                pred_list = model(batch)
+
+                # Every head sees the same batch, so the mean over all (graph, position) pairs equals the mean of the
+                # per-head losses while only launching a single cross entropy
+                pred = torch.stack(pred_list, dim=1).to(torch.float32)  # [batch_size, max_seq_len, num_vocab]
+                loss = multicls_criterion(pred.reshape(-1, pred.shape[-1]), batch.y_arr.reshape(-1))
 
-            loss = 0
-            for i in range(len(pred_list)):
-                loss += multicls_criterion(pred_list[i].to(torch.float32), batch.y_arr[:, i])
+            # Gradients are accumulated over accum_steps micro-batches before each optimizer step
+            scaler.scale(loss / accum_steps).backward()
+            num_accumulated += 1
+            if num_accumulated == accum_steps:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+                num_accumulated = 0
 
-            loss = loss / len(pred_list)
+            loss_accum += loss.detach()
 
-            loss.backward()
-            optimizer.step()
+        if profiler is not None:
+            profiler.step()
 
-            loss_accum += loss.item()
+    if num_accumulated > 0:
+        # Apply the gradients of the last, incomplete accumulation
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
 
-    logging.info('Average training loss: {}'.format(loss_accum / (step + 1)))
+    logging.info('Average training loss: {}'.format((loss_accum / (step + 1)).item()))
 
 
-def eval(model, device, loader, evaluator, arr_to_seq):
+def eval(model, device, loader, evaluator, mat_to_seqs, amp_dtype=None):
     model.eval()
     seq_ref_list = []
-    seq_pred_list = []
+    mat_list = []
 
-    for step, batch in enumerate(tqdm(loader, desc="Iteration")):
-        batch = batch.to(device)
+    for step, batch in enumerate(tqdm(CUDAPrefetchLoader(loader, device), desc="Iteration")):
 
         if batch.x.shape[0] == 1:
             pass
         else:
-            with torch.no_grad():
-                pred_list = model(batch)
-
-            mat = []
-            for i in range(len(pred_list)):
-                mat.append(torch.argmax(pred_list[i], dim=1).view(-1, 1))
-            mat = torch.cat(mat, dim=1)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                with torch.inference_mode():
+                    pred_list = model(batch)
 
-            seq_pred = [arr_to_seq(arr) for arr in mat]
+            mat = torch.stack(pred_list, dim=1).argmax(dim=-1)  # [batch_size, max_seq_len]
+            # Kept on the device, so there is a single device to host copy after the loop
+            mat_list.append(mat)
 
             # PyG = 1.4.3
             # seq_ref = [batch.y[i][0] for i in range(len(batch.y))]
@@ -79,7 +100,9 @@ def eval(model, device, loader, evaluator, arr_to_seq):
             seq_ref = [batch.y[i] for i in range(len(batch.y))]
 
             seq_ref_list.extend(seq_ref)
-            seq_pred_list.extend(seq_pred)
+
+    mat = torch.cat(mat_list, dim=0).cpu()
+    seq_pred_list = mat_to_seqs(mat)
 
     input_dict = {"seq_ref": seq_ref_list, "seq_pred": seq_pred_list}
 
@@ -107,11 +130,15 @@ def main():
                         help='dimensionality of hidden units in GNNs (default: 300)')
     parser.add_argument('--batch_size', type=int, default=128,
                         help='input batch size for training (default: 128)')
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help='number of batches to accumulate gradients over per optimizer step (default: 1)')
     parser.add_argument('--epochs', type=int, default=25,
                         help='number of epochs to train (default: 25)')
     parser.add_argument('--random_split', dest='random_split', type=str2bool, default=False)
-    parser.add_argument('--num_workers', type=int, default=0,
-                        help='number of workers (default: 0)')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='number of dataloader workers (default: 4)')
+    parser.add_argument('--prefetch_factor', type=int, default=4,
+                        help='number of batches loaded in advance by each worker (default: 4)')
     parser.add_argument('--dataset', type=str, default="ogbg-code2",
                         choices = ["ogbg-code2"],
                         help='dataset name (default: ogbg-code2)')
@@ -129,12 +156,31 @@ def main():
     parser.add_argument('--expander_edge_handling', type=str, default='masking',
                         choices=['masking', 'learn-features', 'summation', 'summation-mlp'],
                         help='method to handle expander edge nodes')
+    parser.add_argument('--eval_train', dest='eval_train', type=str2bool, default=True,
+                        help='whether to evaluate on (a subset of) the training set every epoch (default: True)')
+    parser.add_argument('--eval_train_size', type=int, default=5000,
+                        help='number of training graphs evaluated with --eval_train, -1 for all (default: 5000)')
+    parser.add_argument('--deterministic', dest='deterministic', type=str2bool, default=False,
+                        help='whether to disable cuDNN autotuning and TF32 matmuls for reproducibility')
+    parser.add_argument('--dist_timeout', type=float, default=24,
+                        help='timeout in hours of the distributed collectives, including the wait for the dataset to '
+                             'be processed when launched with torchrun (default: 24)')
+    parser.add_argument('--compile', dest='compile', type=str2bool, default=False,
+                        help='whether to compile the model with torch.compile (requires PyTorch >= 2.0)')
+    parser.add_argument('--compile_norm_act', dest='compile_norm_act', type=str2bool, default=False,
+                        help='whether to compile the batch norm, relu and dropout after each convolution '
+                             '(requires PyTorch >= 2.0, default: False)')
+    parser.add_argument('--profile', dest='profile', type=str2bool, default=False,
+                        help='whether to record a profiler trace of the first training steps (default: False)')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                        help='mixed precision dtype used for the forward pass (default: none)')
     # parser.add_argument('--save_dir', type=str, default="",
     #                      help='save_dir to output result (default: )')
     args = parser.parse_args()
 
     # Set the seed for everything
     set_seed(args.seed)
+    set_backend_flags(args.deterministic)
 
     expander_graph_generation_fn = None
     if args.expander_graph_generation_method == "perfect-matchings":
@@ -158,18 +204,33 @@ def main():
             args.expander_graph_order,
             "code2")
 
-    device = torch.device("cuda:" + str(args.device)) if torch.cuda.is_available() else torch.device("cpu")
+    # When launched with torchrun (e.g. `torchrun --nproc_per_node=N -m exp.run_code2`) train with one process per GPU
+    distributed = "LOCAL_RANK" in os.environ
+    if distributed:
+        # Longer than the default 30 minute timeout, as the other processes wait while the dataset is processed
+        dist.init_process_group(backend="nccl", timeout=datetime.timedelta(hours=args.dist_timeout))
+        rank = dist.get_rank()
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda:" + str(local_rank))
+    else:
+        rank = 0
+        device = torch.device("cuda:" + str(args.device)) if torch.cuda.is_available() else torch.device("cpu")
 
     # Set path
     path = os.path.join(os.getcwd() + f"/logs/{args.dataset}/")
-    if not os.path.exists(path):
+    if rank == 0 and not os.path.exists(path):
         os.makedirs(path)
     save_dir = os.path.join(path, f"{args.expander_graph_generation_method}_seed{args.seed}_")
-    logging.basicConfig(level=logging.INFO,
-                        handlers=[
-                            logging.FileHandler(save_dir + "log.txt"),
-                            logging.StreamHandler()
-                        ])
+    if rank == 0:
+        logging.basicConfig(level=logging.INFO,
+                            handlers=[
+                                logging.FileHandler(save_dir + "log.txt"),
+                                logging.StreamHandler()
+                            ])
+    else:
+        # Only the main process logs progress
+        logging.basicConfig(level=logging.WARNING)
     logging.info(args)
     logging.info(f'Using: {device}')
     logging.info(f"Using seed {args.seed}")
@@ -178,13 +239,27 @@ def main():
     logging.info(f"Expander graph order: {args.expander_graph_order}")
     logging.info(f"Expander edge handling: {args.expander_edge_handling}")
 
-    ### automatic dataloading and splitting
-    if not args.expander:
-        dataset = PygGraphPropPredDataset(name=args.dataset)
+    ### set the pre_transform function
+    # augment_edge: add next-token edge as well as inverse edges. add edge attributes.
+    # It is deterministic, so it is applied once when processing the dataset (after the expander graph generation)
+    # rather than to every sample in every epoch. The processed files only depend on the expander configuration, so
+    # they are shared by all runs using it.
+    if args.expander:
+        pre_transform = transforms.Compose([expander_graph_generation_fn, augment_edge])
+        variant = f"{args.expander_graph_generation_method}_order{args.expander_graph_order}"
     else:
-        dataset = PygGraphPropPredDataset(name=args.dataset, pre_transform=expander_graph_generation_fn)
+        pre_transform = augment_edge
+        variant = "no_expander"
 
-    seq_len_list = np.array([len(seq) for seq in dataset.data.y])
+    ### automatic dataloading and splitting
+    # The main process downloads and processes the dataset first, the others then read the processed files
+    if distributed and rank != 0:
+        dist.barrier()
+    dataset = CachedPygGraphPropPredDataset(name=args.dataset, variant=variant, pre_transform=pre_transform)
+    if distributed and rank == 0:
+        dist.barrier()
+
+    seq_len_list = np.fromiter((len(seq) for seq in dataset.data.y), dtype=np.int32, count=len(dataset.data.y))
     logging.info('Target seqence less or equal to {} is {}%.'.format(args.max_seq_len,
                                                               np.sum(seq_len_list <= args.max_seq_len) / len(
                                                                   seq_len_list)))
@@ -237,7 +312,22 @@ def main():
 
     ### building vocabulary for sequence predition. Only use training data.
 
-    vocab2idx, idx2vocab = get_vocab_mapping([dataset.data.y[i] for i in split_idx['train']], args.num_vocab)
+    # The vocabulary only depends on the training split and num_vocab, so it is cached next to the dataset
+    vocab_path = os.path.join(dataset.root, f"vocab_{args.num_vocab}" +
+                              (f"_random_split_seed{args.seed}" if args.random_split else "") + ".pt")
+    if os.path.exists(vocab_path):
+        vocab2idx, idx2vocab = torch.load(vocab_path)
+    else:
+        vocab2idx, idx2vocab = get_vocab_mapping((dataset.data.y[i] for i in split_idx['train']),
+                                                 args.num_vocab)
+        if rank == 0:
+            # Write atomically, other processes may be checking for the file at the same time
+            torch.save((vocab2idx, idx2vocab), vocab_path + ".tmp")
+            os.replace(vocab_path + ".tmp", vocab_path)
+
+    # Predictions are decoded a whole matrix at a time through numpy indexing into the vocabulary
+    idx2vocab_arr = np.array(idx2vocab, dtype=object)
+    mat_to_seqs = functools.partial(decode_mat_to_seqs, idx2vocab_arr=idx2vocab_arr)
 
     # test encoder and decoder
     # for data in dataset:
@@ -258,21 +348,32 @@ def main():
     # data_augmented = augment_edge(data)
     # logging.info(data_augmented)
 
-    ### set the transform function
-    # augment_edge: add next-token edge as well as inverse edges. add edge attributes.
     # encode_y_to_arr: add y_arr to PyG data object, indicating the array representation of a sequence.
-    dataset.transform = transforms.Compose(
-        [augment_edge, lambda data: encode_y_to_arr(data, vocab2idx, args.max_seq_len)])
+    # It depends on the vocabulary (i.e. on num_vocab and, with a random split, the seed) but is cheap, so it is added
+    # to the collated dataset here instead of by the pre_transform.
+    add_graph_attr(dataset, 'y_arr', torch.cat([encode_seq_to_arr(seq, vocab2idx, args.max_seq_len)
+                                                 for seq in dataset.data.y], dim=0))
 
     ### automatic evaluator. takes dataset name as input
     evaluator = Evaluator(args.dataset)
 
-    train_loader = DataLoader(dataset[split_idx["train"]], batch_size=args.batch_size, shuffle=True,
-                              num_workers=args.num_workers)
-    valid_loader = DataLoader(dataset[split_idx["valid"]], batch_size=args.batch_size, shuffle=False,
-                              num_workers=args.num_workers)
-    test_loader = DataLoader(dataset[split_idx["test"]], batch_size=args.batch_size, shuffle=False,
-                             num_workers=args.num_workers)
+    loader_kwargs = get_loader_kwargs(args.num_workers, args.prefetch_factor)
+
+    train_dataset = dataset[split_idx["train"]]
+    if distributed:
+        train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=args.seed)
+        train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False, sampler=train_sampler,
+                                  **loader_kwargs)
+    else:
+        train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, **loader_kwargs)
+    valid_loader = DataLoader(dataset[split_idx["valid"]], batch_size=args.batch_size, shuffle=False, **loader_kwargs)
+    test_loader = DataLoader(dataset[split_idx["test"]], batch_size=args.batch_size, shuffle=False, **loader_kwargs)
+    if args.eval_train:
+        # The train metric is only logged, so a fixed subset of the training set is enough. Evaluating all of it
+        # costs as much as a training pass.
+        train_eval_idx = split_idx["train"] if args.eval_train_size < 0 else split_idx["train"][:args.eval_train_size]
+        train_eval_loader = DataLoader(dataset[train_eval_idx], batch_size=args.batch_size, shuffle=False,
+                                       **loader_kwargs)
 
     nodetypes_mapping = pd.read_csv(os.path.join(dataset.root, 'mapping', 'typeidx2type.csv.gz'))
     nodeattributes_mapping = pd.read_csv(os.path.join(dataset.root, 'mapping', 'attridx2attr.csv.gz'))
@@ -287,18 +388,36 @@ def main():
     node_encoder = ASTNodeEncoder(args.emb_dim, num_nodetypes=len(nodetypes_mapping['type']),
                                   num_nodeattributes=len(nodeattributes_mapping['attr']), max_depth=20)
 
+    if args.compile_norm_act and not supports_compile('the batch norm and activations'):
+        args.compile_norm_act = False
+
     if args.gnn == 'gin':
         model = GNN(task="code2", num_class=len(vocab2idx), max_seq_len=args.max_seq_len, node_encoder=node_encoder,
                     num_layer=args.num_layer, gnn_type='gin', emb_dim=args.emb_dim, drop_ratio=args.drop_ratio,
-                    expander=args.expander, expander_edge_handling=args.expander_edge_handling).to(device)
+                    expander=args.expander, expander_edge_handling=args.expander_edge_handling,
+                    compile_norm_act=args.compile_norm_act).to(device)
     elif args.gnn == 'gcn':
         model = GNN(task="code2", num_class=len(vocab2idx), max_seq_len=args.max_seq_len, node_encoder=node_encoder,
                     num_layer=args.num_layer, gnn_type='gcn', emb_dim=args.emb_dim, drop_ratio=args.drop_ratio,
-                    expander=args.expander, expander_edge_handling=args.expander_edge_handling).to(device)
+                    expander=args.expander, expander_edge_handling=args.expander_edge_handling,
+                    compile_norm_act=args.compile_norm_act).to(device)
     else:
         raise ValueError('Invalid GNN type')
 
-    optimizer = optim.Adam(model.parameters(), lr=0.001)
+    # Only training goes through DDP, which has to find the expander parameters unused by the loss (e.g. summation)
+    if distributed:
+        train_model = DDP(model, device_ids=[local_rank], find_unused_parameters=args.expander)
+    else:
+        train_model = model
+    eval_model = model
+
+    if args.compile and supports_compile('the model'):
+        train_model = compile_model(train_model)
+        eval_model = compile_model(model)
+
+    # The fused implementation updates all parameters in a single kernel, it is only available on CUDA
+    optimizer = optim.Adam(model.parameters(), lr=0.001, fused=device.type == 'cuda')
+    amp_dtype, scaler = get_amp(args.amp)
 
     logging.info(f'#Params: {sum(p.numel() for p in model.parameters())}')
 
@@ -306,43 +425,65 @@ def main():
     test_curve = []
     train_curve = []
 
+    # The per epoch curves are appended to a JSON lines file, so the run can be followed (and survives crashes)
+    # without rewriting the whole curves every epoch
+    curves_file = open(save_dir + "_curves.jsonl", "w") if rank == 0 else None
+
     best_val_so_far = 0
     for epoch in range(1, args.epochs + 1):
         logging.info("=====Epoch {}".format(epoch))
         logging.info('Training...')
-        train(model, device, train_loader, optimizer)
-
-        logging.info('Evaluating...')
-        train_perf = eval(model, device, train_loader, evaluator,
-                          arr_to_seq=lambda arr: decode_arr_to_seq(arr, idx2vocab))
-        valid_perf = eval(model, device, valid_loader, evaluator,
-                          arr_to_seq=lambda arr: decode_arr_to_seq(arr, idx2vocab))
-        test_perf = eval(model, device, test_loader, evaluator,
-                         arr_to_seq=lambda arr: decode_arr_to_seq(arr, idx2vocab))
-
-        logging.info({'Train': train_perf, 'Validation': valid_perf, 'Test': test_perf})
-
-        train_curve.append(train_perf[dataset.eval_metric])
-        valid_curve.append(valid_perf[dataset.eval_metric])
-        test_curve.append(test_perf[dataset.eval_metric])
-        torch.save({'Val': valid_curve, 'Test': test_curve, 'Train': train_curve}, save_dir + "_curves")
-        if valid_perf[dataset.eval_metric] > best_val_so_far:
-            torch.save(model.state_dict(), save_dir + "best_val_model.pt")
-            best_val_so_far = valid_perf[dataset.eval_metric]
-
-    logging.info('F1')
-    best_val_epoch = np.argmax(np.array(valid_curve))
-    best_train = max(train_curve)
-    logging.info('Finished training!')
-    logging.info('Best validation score: {}'.format(valid_curve[best_val_epoch]))
-    logging.info('Test score: {}'.format(test_curve[best_val_epoch]))
-
-    if not save_dir == '':
+        if distributed:
+            train_sampler.set_epoch(epoch)
+        with get_profiler(args.profile and epoch == 1, device, save_dir + "tb") as prof:
+            train(train_model, device, train_loader, optimizer, scaler, amp_dtype, args.accum_steps, profiler=prof)
+
+        # Only the main process evaluates, the others wait for it before the next epoch
+        if rank == 0:
+            logging.info('Evaluating...')
+            if args.eval_train:
+                train_perf = eval(eval_model, device, train_eval_loader, evaluator,
+                                  mat_to_seqs=mat_to_seqs, amp_dtype=amp_dtype)
+            else:
+                train_perf = {dataset.eval_metric: float('nan')}
+            valid_perf = eval(eval_model, device, valid_loader, evaluator,
+                              mat_to_seqs=mat_to_seqs, amp_dtype=amp_dtype)
+            test_perf = eval(eval_model, device, test_loader, evaluator,
+                             mat_to_seqs=mat_to_seqs, amp_dtype=amp_dtype)
+
+            logging.info({'Train': train_perf, 'Validation': valid_perf, 'Test': test_perf})
+
+            train_curve.append(train_perf[dataset.eval_metric])
+            valid_curve.append(valid_perf[dataset.eval_metric])
+            test_curve.append(test_perf[dataset.eval_metric])
+            curves_file.write(json.dumps({'Epoch': epoch, 'Val': valid_curve[-1], 'Test': test_curve[-1],
+                                          'Train': train_curve[-1]}) + "\n")
+            curves_file.flush()
+            if valid_perf[dataset.eval_metric] > best_val_so_far:
+                torch.save(model.state_dict(), save_dir + "best_val_model.pt")
+                best_val_so_far = valid_perf[dataset.eval_metric]
+        if distributed:
+            dist.barrier()
+
+    if rank == 0:
+        curves_file.close()
+
+        logging.info('F1')
+        best_val_epoch = np.argmax(np.array(valid_curve))
+        best_train = max(train_curve)
+        logging.info('Finished training!')
+        logging.info('Best validation score: {}'.format(valid_curve[best_val_epoch]))
+        logging.info('Test score: {}'.format(test_curve[best_val_epoch]))
+
+    if rank == 0 and not save_dir == '':
         torch.save({'Val': valid_curve[best_val_epoch], 'Test': test_curve[best_val_epoch],
                     'Train': train_curve[best_val_epoch], 'BestTrain': best_train}, save_dir + "_best")
         torch.save({'Val': valid_curve, 'Test': test_curve, 'Train': train_curve}, save_dir + "_curves")
         torch.save(model.state_dict(), save_dir + "final_model.pt")
 
+    if distributed:
+        dist.destroy_process_group()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,66 +1,90 @@
+import datetime
 import functools
 import argparse
 import numpy as np
 import os
 import logging
 import torch
+import torch.distributed as dist
 import torch.optim as optim
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 from torch_geometric.loader import DataLoader
 
 from models.gnn import GNN
 from exp import expander_graph_generation
+from exp.dataset import CachedPygGraphPropPredDataset
+from exp.loader import CUDAPrefetchLoader
+from exp.utils import get_loader_kwargs, supports_compile, compile_model, get_amp, get_profiler
 
 ### importing OGB
 from ogb.graphproppred import PygGraphPropPredDataset, Evaluator
 
 ### importing utils
-from models.utils import str2bool, set_seed
+from models.utils import str2bool, set_seed, set_backend_flags
 
 cls_criterion = torch.nn.BCEWithLogitsLoss()
 reg_criterion = torch.nn.MSELoss()
 
 
-def train(model, device, loader, optimizer, task_type):
+def train(model, device, loader, optimizer, task_type, scaler, amp_dtype=None, accum_steps=1, profiler=None):
     model.train()
 
-    for step, batch in enumerate(tqdm(loader, desc="Iteration")):
-        batch = batch.to(device)
+    optimizer.zero_grad(set_to_none=True)
+    num_accumulated = 0
+    for step, batch in enumerate(tqdm(CUDAPrefetchLoader(loader, device), desc="Iteration")):
 
         if batch.x.shape[0] == 1 or batch.batch[-1] == 0:
             pass
         else:
-            pred = model(batch)
-            optimizer.zero_grad()
-            ## ignore nan targets (unlabeled) when computing training loss.
-            is_labeled = batch.y == batch.y
-            if "classification" in task_type:
-                loss = cls_criterion(pred.to(torch.float32)[is_labeled], batch.y.to(torch.float32)[is_labeled])
-            else:
-                loss = reg_criterion(pred.to(torch.float32)[is_labeled], batch.y.to(torch.float32)[is_labeled])
-            loss.backward()
-            optimizer.step()
-
-
-def eval(model, device, loader, evaluator):
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                pred = model(batch)
+                ## ignore nan targets (unlabeled) when computing training loss.
+                is_labeled = batch.y == batch.y
+                if "classification" in task_type:
+                    loss = cls_criterion(pred.to(torch.float32)[is_labeled], batch.y.to(torch.float32)[is_labeled])
+                else:
+                    loss = reg_criterion(pred.to(torch.float32)[is_labeled], batch.y.to(torch.float32)[is_labeled])
+            # Gradients are accumulated over accum_steps micro-batches before each optimizer step
+            scaler.scale(loss / accum_steps).backward()
+            num_accumulated += 1
+            if num_accumulated == accum_steps:
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
+                num_accumulated = 0
+
+        if profiler is not None:
+            profiler.step()
+
+    if num_accumulated > 0:
+        # Apply the gradients of the last, incomplete accumulation
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
+
+
+def eval(model, device, loader, evaluator, amp_dtype=None):
     model.eval()
     y_true = []
     y_pred = []
 
-    for step, batch in enumerate(tqdm(loader, desc="Iteration")):
-        batch = batch.to(device)
+    for step, batch in enumerate(tqdm(CUDAPrefetchLoader(loader, device), desc="Iteration")):
 
         if batch.x.shape[0] == 1:
             pass
         else:
-            with torch.no_grad():
-                pred = model(batch)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                with torch.inference_mode():
+                    pred = model(batch).to(torch.float32)
 
-            y_true.append(batch.y.view(pred.shape).detach().cpu())
-            y_pred.append(pred.detach().cpu())
+            # Cloned, as with CUDA graphs (--compile) the next batch overwrites the model's output buffer
+            y_true.append(batch.y.view(pred.shape).detach())
+            y_pred.append(pred.detach().clone())
 
-    y_true = torch.cat(y_true, dim=0).numpy()
-    y_pred = torch.cat(y_pred, dim=0).numpy()
+    y_true = torch.cat(y_true, dim=0).cpu().numpy()
+    y_pred = torch.cat(y_pred, dim=0).cpu().numpy()
 
     input_dict = {"y_true": y_true, "y_pred": y_pred}
 
@@ -84,10 +108,14 @@ def main():
                         help='dimensionality of hidden units in GNNs (default: 300)')
     parser.add_argument('--batch_size', type=int, default=32,
                         help='input batch size for training (default: 32)')
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help='number of batches to accumulate gradients over per optimizer step (default: 1)')
     parser.add_argument('--epochs', type=int, default=100,
                         help='number of epochs to train (default: 100)')
-    parser.add_argument('--num_workers', type=int, default=0,
-                        help='number of workers (default: 0)')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='number of dataloader workers (default: 4)')
+    parser.add_argument('--prefetch_factor', type=int, default=4,
+                        help='number of batches loaded in advance by each worker (default: 4)')
     parser.add_argument('--dataset', type=str, default="ogbg-molhiv",
                         choices=['ogbg-molhiv', 'ogbg-molpcba'],
                         help='dataset name (default: ogbg-molhiv)')
@@ -105,27 +133,61 @@ def main():
     parser.add_argument('--expander_edge_handling', type=str, default='masking',
                         choices=['masking', 'learn-features', 'summation', 'summation-mlp'],
                         help='method to handle expander edge nodes')
+    parser.add_argument('--eval_train', dest='eval_train', type=str2bool, default=True,
+                        help='whether to evaluate on (a subset of) the training set every epoch (default: True)')
+    parser.add_argument('--eval_train_size', type=int, default=5000,
+                        help='number of training graphs evaluated with --eval_train, -1 for all (default: 5000)')
+    parser.add_argument('--deterministic', dest='deterministic', type=str2bool, default=False,
+                        help='whether to disable cuDNN autotuning and TF32 matmuls for reproducibility')
+    parser.add_argument('--dist_timeout', type=float, default=24,
+                        help='timeout in hours of the distributed collectives, including the wait for the dataset to '
+                             'be processed when launched with torchrun (default: 24)')
+    parser.add_argument('--compile', dest='compile', type=str2bool, default=False,
+                        help='whether to compile the model with torch.compile (requires PyTorch >= 2.0)')
+    parser.add_argument('--compile_norm_act', dest='compile_norm_act', type=str2bool, default=False,
+                        help='whether to compile the batch norm, relu and dropout after each convolution '
+                             '(requires PyTorch >= 2.0, default: False)')
+    parser.add_argument('--profile', dest='profile', type=str2bool, default=False,
+                        help='whether to record a profiler trace of the first training steps (default: False)')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                        help='mixed precision dtype used for the forward pass (default: none)')
     parser.add_argument('--feature', type=str, default="full",
                         help='full feature or simple feature')
     # parser.add_argument('--save_dir', type=str, default="",
     #                     help='save_dir to output result (default: )')
     args = parser.parse_args()
 
-    device = torch.device("cuda:" + str(args.device)) if torch.cuda.is_available() else torch.device("cpu")
+    # When launched with torchrun (e.g. `torchrun --nproc_per_node=N -m exp.run_mol`) train with one process per GPU
+    distributed = "LOCAL_RANK" in os.environ
+    if distributed:
+        # Longer than the default 30 minute timeout, as the other processes wait while the dataset is processed
+        dist.init_process_group(backend="nccl", timeout=datetime.timedelta(hours=args.dist_timeout))
+        rank = dist.get_rank()
+        local_rank = int(os.environ["LOCAL_RANK"])
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda:" + str(local_rank))
+    else:
+        rank = 0
+        device = torch.device("cuda:" + str(args.device)) if torch.cuda.is_available() else torch.device("cpu")
 
     # Set the seed for everything
     set_seed(args.seed)
+    set_backend_flags(args.deterministic)
 
     # Set path
     path = os.path.join(os.getcwd() + f"/logs/{args.dataset}/")
-    if not os.path.exists(path):
+    if rank == 0 and not os.path.exists(path):
         os.makedirs(path)
     save_dir = os.path.join(path, f"{args.expander_graph_generation_method}_seed{args.seed}_")
-    logging.basicConfig(level=logging.INFO,
-                        handlers=[
-                            logging.FileHandler(save_dir + "log.txt"),
-                            logging.StreamHandler()
-                        ])
+    if rank == 0:
+        logging.basicConfig(level=logging.INFO,
+                            handlers=[
+                                logging.FileHandler(save_dir + "log.txt"),
+                                logging.StreamHandler()
+                            ])
+    else:
+        # Only the main process logs progress
+        logging.basicConfig(level=logging.WARNING)
     logging.info(args)
     logging.info(f'Using: {device}')
     logging.info(f"Using seed {args.seed}")
@@ -154,10 +216,18 @@ def main():
                                                          "mol")
 
     ### automatic dataloading and splitting
+    # The main process downloads and processes the dataset first, the others then read the processed files
+    if distributed and rank != 0:
+        dist.barrier()
     if not args.expander:
         dataset = PygGraphPropPredDataset(name=args.dataset)
     else:
-        dataset = PygGraphPropPredDataset(name=args.dataset, pre_transform=expander_graph_generation_fn)
+        # Each expander configuration gets its own processed files, so the expander graphs are only generated once
+        variant = f"{args.expander_graph_generation_method}_order{args.expander_graph_order}"
+        dataset = CachedPygGraphPropPredDataset(name=args.dataset, variant=variant,
+                                                pre_transform=expander_graph_generation_fn)
+    if distributed and rank == 0:
+        dist.barrier()
 
     if args.feature == 'full':
         pass
@@ -172,23 +242,51 @@ def main():
     ### automatic evaluator. takes dataset name as input
     evaluator = Evaluator(args.dataset)
 
-    train_loader = DataLoader(dataset[split_idx["train"]], batch_size=args.batch_size, shuffle=True,
-                              num_workers=args.num_workers)
-    valid_loader = DataLoader(dataset[split_idx["valid"]], batch_size=args.batch_size, shuffle=False,
-                              num_workers=args.num_workers)
-    test_loader = DataLoader(dataset[split_idx["test"]], batch_size=args.batch_size, shuffle=False,
-                             num_workers=args.num_workers)
+    loader_kwargs = get_loader_kwargs(args.num_workers, args.prefetch_factor)
+
+    train_dataset = dataset[split_idx["train"]]
+    if distributed:
+        train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=args.seed)
+        train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False, sampler=train_sampler,
+                                  **loader_kwargs)
+    else:
+        train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, **loader_kwargs)
+    valid_loader = DataLoader(dataset[split_idx["valid"]], batch_size=args.batch_size, shuffle=False, **loader_kwargs)
+    test_loader = DataLoader(dataset[split_idx["test"]], batch_size=args.batch_size, shuffle=False, **loader_kwargs)
+    if args.eval_train:
+        # The train metric is only logged, so a fixed subset of the training set is enough
+        train_eval_idx = split_idx["train"] if args.eval_train_size < 0 else split_idx["train"][:args.eval_train_size]
+        train_eval_loader = DataLoader(dataset[train_eval_idx], batch_size=args.batch_size, shuffle=False,
+                                       **loader_kwargs)
+
+    if args.compile_norm_act and not supports_compile('the batch norm and activations'):
+        args.compile_norm_act = False
 
     if args.gnn == 'gin':
         model = GNN(gnn_type='gin', task="mol", num_class=dataset.num_tasks, num_layer=args.num_layer, emb_dim=args.emb_dim,
-                    drop_ratio=args.drop_ratio, expander=args.expander, expander_edge_handling=args.expander_edge_handling).to(device)
+                    drop_ratio=args.drop_ratio, expander=args.expander, expander_edge_handling=args.expander_edge_handling,
+                    compile_norm_act=args.compile_norm_act).to(device)
     elif args.gnn == 'gcn':
         model = GNN(gnn_type='gcn', task="mol", num_class=dataset.num_tasks, num_layer=args.num_layer, emb_dim=args.emb_dim,
-                    drop_ratio=args.drop_ratio, expander=args.expander, expander_edge_handling=args.expander_edge_handling).to(device)
+                    drop_ratio=args.drop_ratio, expander=args.expander, expander_edge_handling=args.expander_edge_handling,
+                    compile_norm_act=args.compile_norm_act).to(device)
     else:
         raise ValueError('Invalid GNN type')
 
-    optimizer = optim.Adam(model.parameters(), lr=0.001)
+    # Only training goes through DDP, which has to find the expander parameters unused by the loss (e.g. summation)
+    if distributed:
+        train_model = DDP(model, device_ids=[local_rank], find_unused_parameters=args.expander)
+    else:
+        train_model = model
+    eval_model = model
+
+    if args.compile and supports_compile('the model'):
+        train_model = compile_model(train_model)
+        eval_model = compile_model(model)
+
+    # The fused implementation updates all parameters in a single kernel, it is only available on CUDA
+    optimizer = optim.Adam(model.parameters(), lr=0.001, fused=device.type == 'cuda')
+    amp_dtype, scaler = get_amp(args.amp)
 
     valid_curve = []
     test_curve = []
@@ -198,39 +296,54 @@ def main():
     for epoch in range(1, args.epochs + 1):
         logging.info("=====Epoch {}".format(epoch))
         logging.info('Training...')
-        train(model, device, train_loader, optimizer, dataset.task_type)
-
-        logging.info('Evaluating...')
-        train_perf = eval(model, device, train_loader, evaluator)
-        valid_perf = eval(model, device, valid_loader, evaluator)
-        test_perf = eval(model, device, test_loader, evaluator)
-
-        logging.info({'Train': train_perf, 'Validation': valid_perf, 'Test': test_perf})
-
-        train_curve.append(train_perf[dataset.eval_metric])
-        valid_curve.append(valid_perf[dataset.eval_metric])
-        test_curve.append(test_perf[dataset.eval_metric])
-        if 'classification' in dataset.task_type and valid_perf[dataset.eval_metric] > best_val_so_far:
-            torch.save(model.state_dict(), save_dir + "best_val_model.pt")
-            best_val_so_far = valid_perf[dataset.eval_metric]
-
-    if 'classification' in dataset.task_type:
-        best_val_epoch = np.argmax(np.array(valid_curve))
-        best_train = max(train_curve)
-    else:
-        best_val_epoch = np.argmin(np.array(valid_curve))
-        best_train = min(train_curve)
+        if distributed:
+            train_sampler.set_epoch(epoch)
+        with get_profiler(args.profile and epoch == 1, device, save_dir + "tb") as prof:
+            train(train_model, device, train_loader, optimizer, dataset.task_type, scaler, amp_dtype, args.accum_steps,
+                  profiler=prof)
+
+        # Only the main process evaluates, the others wait for it before the next epoch
+        if rank == 0:
+            logging.info('Evaluating...')
+            if args.eval_train:
+                train_perf = eval(eval_model, device, train_eval_loader, evaluator, amp_dtype)
+            else:
+                train_perf = {dataset.eval_metric: float('nan')}
+            valid_perf = eval(eval_model, device, valid_loader, evaluator, amp_dtype)
+            test_perf = eval(eval_model, device, test_loader, evaluator, amp_dtype)
+
+            logging.info({'Train': train_perf, 'Validation': valid_perf, 'Test': test_perf})
+
+            train_curve.append(train_perf[dataset.eval_metric])
+            valid_curve.append(valid_perf[dataset.eval_metric])
+            test_curve.append(test_perf[dataset.eval_metric])
+            if 'classification' in dataset.task_type and valid_perf[dataset.eval_metric] > best_val_so_far:
+                torch.save(model.state_dict(), save_dir + "best_val_model.pt")
+                best_val_so_far = valid_perf[dataset.eval_metric]
+        if distributed:
+            dist.barrier()
+
+    if rank == 0:
+        if 'classification' in dataset.task_type:
+            best_val_epoch = np.argmax(np.array(valid_curve))
+            best_train = max(train_curve)
+        else:
+            best_val_epoch = np.argmin(np.array(valid_curve))
+            best_train = min(train_curve)
 
-    logging.info('Finished training!')
-    logging.info('Best validation score: {}'.format(valid_curve[best_val_epoch]))
-    logging.info('Test score: {}'.format(test_curve[best_val_epoch]))
+        logging.info('Finished training!')
+        logging.info('Best validation score: {}'.format(valid_curve[best_val_epoch]))
+        logging.info('Test score: {}'.format(test_curve[best_val_epoch]))
 
-    if not save_dir == '':
+    if rank == 0 and not save_dir == '':
         torch.save({'Val': valid_curve[best_val_epoch], 'Test': test_curve[best_val_epoch],
                     'Train': train_curve[best_val_epoch], 'BestTrain': best_train}, save_dir + "_best")
         torch.save({'Val': valid_curve, 'Test': test_curve, 'Train': train_curve}, save_dir + "_curves")
         torch.save(model.state_dict(), save_dir + "final_model.pt")
 
+    if distributed:
+        dist.destroy_process_group()
+
 
 if __name__ == "__main__":
     # import pdb; pdb.set_trace()
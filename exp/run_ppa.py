@@ -6,6 +6,8 @@ from torch_geometric.loader import DataLoader
 import torch.optim as optim
 from models.gnn import GNN
 from exp import expander_graph_generation
+from exp.dataset import CachedPygGraphPropPredDataset
+from exp.utils import get_loader_kwargs, supports_compile, compile_model, get_amp
 
 from tqdm import tqdm
 import argparse
@@ -15,59 +17,57 @@ import numpy as np
 from ogb.graphproppred import PygGraphPropPredDataset, Evaluator
 
 ### importing utils
-from models.utils import str2bool, set_seed
+from models.utils import str2bool, set_seed, set_backend_flags
 
 multicls_criterion = torch.nn.CrossEntropyLoss()
 
 
-def train(model, device, loader, optimizer):
+def train(model, device, loader, optimizer, scaler, amp_dtype=None):
     model.train()
 
     for step, batch in enumerate(tqdm(loader, desc="Iteration")):
-        batch = batch.to(device)
+        batch = batch.to(device, non_blocking=True)
 
-        if batch.x.shape[0] == 1 or batch.batch[-1] == 0:
+        if batch.num_nodes == 1 or batch.batch[-1] == 0:
             pass
         else:
-            pred = model(batch)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                pred = model(batch)
+                loss = multicls_criterion(pred.to(torch.float32), batch.y.view(-1, ))
             optimizer.zero_grad()
 
-            loss = multicls_criterion(pred.to(torch.float32), batch.y.view(-1, ))
-
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
 
-def eval(model, device, loader, evaluator):
+def eval(model, device, loader, evaluator, amp_dtype=None):
     model.eval()
     y_true = []
     y_pred = []
 
     for step, batch in enumerate(tqdm(loader, desc="Iteration")):
-        batch = batch.to(device)
+        batch = batch.to(device, non_blocking=True)
 
-        if batch.x.shape[0] == 1:
+        if batch.num_nodes == 1:
             pass
         else:
-            with torch.no_grad():
-                pred = model(batch)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                with torch.no_grad():
+                    pred = model(batch)
 
-            y_true.append(batch.y.view(-1, 1).detach().cpu())
-            y_pred.append(torch.argmax(pred.detach(), dim=1).view(-1, 1).cpu())
+            # Kept on the device, so there is a single device to host copy after the loop
+            y_true.append(batch.y.view(-1, 1))
+            y_pred.append(torch.argmax(pred, dim=1, keepdim=True))
 
-    y_true = torch.cat(y_true, dim=0).numpy()
-    y_pred = torch.cat(y_pred, dim=0).numpy()
+    y_true = torch.cat(y_true, dim=0).cpu().numpy()
+    y_pred = torch.cat(y_pred, dim=0).cpu().numpy()
 
     input_dict = {"y_true": y_true, "y_pred": y_pred}
 
     return evaluator.eval(input_dict)
 
 
-def add_zeros(data):
-    data.x = torch.zeros(data.num_nodes, dtype=torch.long)
-    return data
-
-
 def main():
     # Training settings
     parser = argparse.ArgumentParser(description='GNN baselines on ogbg-ppa data with Pytorch Geometrics')
@@ -87,11 +87,29 @@ def main():
                         help='input batch size for training (default: 32)')
     parser.add_argument('--epochs', type=int, default=100,
                         help='number of epochs to train (default: 100)')
-    parser.add_argument('--num_workers', type=int, default=0,
-                        help='number of workers (default: 0)')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='number of dataloader workers (default: 4)')
+    parser.add_argument('--prefetch_factor', type=int, default=4,
+                        help='number of batches loaded in advance by each worker (default: 4)')
     parser.add_argument('--dataset', type=str, default="ogbg-ppa",
                         choices = ["ogbg-ppa"],
                         help='dataset name (default: ogbg-ppa)')
+    parser.add_argument('--share_dataset_memory', dest='share_dataset_memory', type=str2bool, default=False,
+                        help='whether to move the dataset into shared memory for the dataloader workers, requires '
+                             '/dev/shm to hold the whole dataset (default: False)')
+    parser.add_argument('--eval_train_every', type=int, default=0,
+                        help='evaluate on the training set every this many epochs, 0 to never evaluate it (default: 0)')
+    parser.add_argument('--deterministic', dest='deterministic', type=str2bool, default=False,
+                        help='whether to disable cuDNN autotuning and TF32 matmuls for reproducibility')
+    parser.add_argument('--compile', dest='compile', type=str2bool, default=False,
+                        help='whether to compile the model with torch.compile (requires PyTorch >= 2.0)')
+    parser.add_argument('--compile_norm_act', dest='compile_norm_act', type=str2bool, default=False,
+                        help='whether to compile the batch norm, relu and dropout after each convolution '
+                             '(requires PyTorch >= 2.0, default: False)')
+    parser.add_argument('--amp', type=str, default='none', choices=['none', 'bf16', 'fp16'],
+                        help='mixed precision dtype used for the forward pass (default: none)')
+    parser.add_argument('--share_edge_encoder', dest='share_edge_encoder', type=str2bool, default=False,
+                        help='whether all GNN layers share one edge encoder, applied once per batch (default: False)')
     parser.add_argument('--expander', dest='expander', type=str2bool, default=False,
                         help='whether to use expander graph propagation')
     parser.add_argument('--expander_graph_generation_method', type=str, default="ramanujan-bipartite",
@@ -114,6 +132,7 @@ def main():
 
     # Set the seed for everything
     set_seed(args.seed)
+    set_backend_flags(args.deterministic)
 
     # Set path
     path = os.path.join(os.getcwd() + f"/logs/{args.dataset}/")
@@ -157,47 +176,74 @@ def main():
 
     ### automatic dataloading and splitting
     if not args.expander:
-        dataset = PygGraphPropPredDataset(name=args.dataset, transform=add_zeros)
+        dataset = PygGraphPropPredDataset(name=args.dataset)
     else:
-        dataset = PygGraphPropPredDataset(name=args.dataset, pre_transform=expander_graph_generation_fn)
+        # Each expander configuration gets its own processed files, so the expander graphs are only generated once
+        variant = f"{args.expander_graph_generation_method}_order{args.expander_graph_order}"
+        dataset = CachedPygGraphPropPredDataset(name=args.dataset, variant=variant,
+                                                pre_transform=expander_graph_generation_fn)
+
+    # Copies the whole dataset (~16 GB) into /dev/shm, the forked workers otherwise share it copy-on-write
+    if args.share_dataset_memory and args.num_workers > 0:
+        (dataset._data if hasattr(dataset, '_data') else dataset.data).share_memory_()
 
     split_idx = dataset.get_idx_split()
 
     ### automatic evaluator. takes dataset name as input
     evaluator = Evaluator(args.dataset)
 
-    train_loader = DataLoader(dataset[split_idx["train"]], batch_size=args.batch_size, shuffle=True,
-                              num_workers=args.num_workers)
-    valid_loader = DataLoader(dataset[split_idx["valid"]], batch_size=args.batch_size, shuffle=False,
-                              num_workers=args.num_workers)
-    test_loader = DataLoader(dataset[split_idx["test"]], batch_size=args.batch_size, shuffle=False,
-                             num_workers=args.num_workers)
+    loader_kwargs = get_loader_kwargs(args.num_workers, args.prefetch_factor)
+
+    train_loader = DataLoader(dataset[split_idx["train"]], batch_size=args.batch_size, shuffle=True, **loader_kwargs)
+    valid_loader = DataLoader(dataset[split_idx["valid"]], batch_size=args.batch_size, shuffle=False, **loader_kwargs)
+    test_loader = DataLoader(dataset[split_idx["test"]], batch_size=args.batch_size, shuffle=False, **loader_kwargs)
+
+    if args.compile_norm_act and not supports_compile('the batch norm and activations'):
+        args.compile_norm_act = False
 
     if args.gnn == 'gin':
-        model = GNN(gnn_type='gin', task="mol", num_class=dataset.num_classes, num_layer=args.num_layer, emb_dim=args.emb_dim,
-                    drop_ratio=args.drop_ratio, expander=args.expander, expander_edge_handling=args.expander_edge_handling).to(device)
+        model = GNN(gnn_type='gin', task="ppa", num_class=dataset.num_classes, num_layer=args.num_layer, emb_dim=args.emb_dim,
+                    drop_ratio=args.drop_ratio, expander=args.expander, expander_edge_handling=args.expander_edge_handling,
+                    compile_norm_act=args.compile_norm_act, share_edge_encoder=args.share_edge_encoder).to(device)
     elif args.gnn == 'gcn':
-        model = GNN(gnn_type='gcn', task="mol", num_class=dataset.num_classes, num_layer=args.num_layer, emb_dim=args.emb_dim,
-                    drop_ratio=args.drop_ratio, expander=args.expander, expander_edge_handling=args.expander_edge_handling).to(device)
+        model = GNN(gnn_type='gcn', task="ppa", num_class=dataset.num_classes, num_layer=args.num_layer, emb_dim=args.emb_dim,
+                    drop_ratio=args.drop_ratio, expander=args.expander, expander_edge_handling=args.expander_edge_handling,
+                    compile_norm_act=args.compile_norm_act, share_edge_encoder=args.share_edge_encoder).to(device)
     else:
         raise ValueError('Invalid GNN type')
 
+    # Training and evaluation use the compiled model, checkpointing uses the underlying model
+    train_model = model
+    eval_model = model
+    if args.compile and supports_compile('the model'):
+        train_model = compile_model(model)
+        eval_model = compile_model(model)
+
     optimizer = optim.Adam(model.parameters(), lr=0.001)
+    amp_dtype, scaler = get_amp(args.amp)
 
     valid_curve = []
     test_curve = []
     train_curve = []
 
     best_val_so_far = 0
+    best_val_state_dict = None
     for epoch in range(1, args.epochs + 1):
         logging.info("=====Epoch {}".format(epoch))
         logging.info('Training...')
-        train(model, device, train_loader, optimizer)
+        train(train_model, device, train_loader, optimizer, scaler, amp_dtype)
 
         logging.info('Evaluating...')
-        train_perf = eval(model, device, train_loader, evaluator)
-        valid_perf = eval(model, device, valid_loader, evaluator)
-        test_perf = eval(model, device, test_loader, evaluator)
+        if args.eval_train_every > 0 and epoch % args.eval_train_every == 0:
+            train_perf = eval(eval_model, device, train_loader, evaluator, amp_dtype)
+        else:
+            train_perf = {dataset.eval_metric: float('nan')}
+        valid_perf = eval(eval_model, device, valid_loader, evaluator, amp_dtype)
+        # Only the test score of the best validation epoch is reported, so other epochs skip the test set
+        if valid_perf[dataset.eval_metric] > best_val_so_far:
+            test_perf = eval(eval_model, device, test_loader, evaluator, amp_dtype)
+        else:
+            test_perf = {dataset.eval_metric: float('nan')}
 
         logging.info({'Train': train_perf, 'Validation': valid_perf, 'Test': test_perf})
 
@@ -205,11 +251,12 @@ def main():
         valid_curve.append(valid_perf[dataset.eval_metric])
         test_curve.append(test_perf[dataset.eval_metric])
         if valid_perf[dataset.eval_metric] > best_val_so_far:
-            torch.save(model.state_dict(), save_dir + "best_val_model.pt")
+            # Kept in (host) memory and written once after training, instead of on every improvement
+            best_val_state_dict = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
             best_val_so_far = valid_perf[dataset.eval_metric]
 
     best_val_epoch = np.argmax(np.array(valid_curve))
-    best_train = max(train_curve)
+    best_train = np.nanmax(np.array(train_curve)) if not np.isnan(train_curve).all() else float('nan')
 
     logging.info('Finished training!')
     logging.info('Best validation score: {}'.format(valid_curve[best_val_epoch]))
@@ -220,6 +267,8 @@ def main():
                     'Train': train_curve[best_val_epoch], 'BestTrain': best_train}, save_dir + "_best")
         torch.save({'Val': valid_curve, 'Test': test_curve, 'Train': train_curve}, save_dir + "_curves")
         torch.save(model.state_dict(), save_dir + "final_model.pt")
+        if best_val_state_dict is not None:
+            torch.save(best_val_state_dict, save_dir + "best_val_model.pt")
 
 
 if __name__ == "__main__":
@@ -12,7 +12,7 @@ python -m exp.run_code2 \
     --batch_size=128 \
     --epochs=25 \
     --random_split=True \
-    --num_workers=0 \
+    --num_workers=4 \
     --dataset=ogbg-code2 \
     --expander=True \
     --expander_graph_generation_method=perfect-matchings \
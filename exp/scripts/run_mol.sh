@@ -9,7 +9,7 @@ python -m exp.run_mol \
     --emb_dim=300 \
     --batch_size=32 \
     --epochs=100 \
-    --num_workers=0 \
+    --num_workers=4 \
     --dataset=ogbg-molhiv \
     --expander=True \
     --expander_graph_generation_method=perfect-matchings \
@@ -0,0 +1,42 @@
+import contextlib
+import logging
+import torch
+
+
+def get_loader_kwargs(num_workers, prefetch_factor):
+    # Build batches in background workers and pin them so host to device copies can overlap with compute
+    loader_kwargs = {'num_workers': num_workers, 'pin_memory': torch.cuda.is_available()}
+    if num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=prefetch_factor)
+    return loader_kwargs
+
+
+def supports_compile(eager_fallback):
+    if hasattr(torch, 'compile'):
+        return True
+    logging.warning(f'torch.compile requires PyTorch >= 2.0, running {eager_fallback} eagerly')
+    return False
+
+
+def compile_model(model):
+    # Batches differ in their number of nodes and edges, so compile for dynamic shapes to avoid recompiling
+    return torch.compile(model, mode='reduce-overhead', dynamic=True)
+
+
+def get_amp(amp):
+    # Mixed precision: autocast the forward pass, fp16 additionally needs loss scaling to avoid gradient underflow
+    amp_dtype = {'none': None, 'bf16': torch.bfloat16, 'fp16': torch.float16}[amp]
+    scaler = torch.cuda.amp.GradScaler(enabled=amp == 'fp16')
+    return amp_dtype, scaler
+
+
+def get_profiler(enabled, device, trace_dir):
+    # Traces the first few steps of training, the trace can be viewed with TensorBoard's profiler plugin
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU] +
+                   ([torch.profiler.ProfilerActivity.CUDA] if device.type == 'cuda' else []),
+        schedule=torch.profiler.schedule(wait=1, warmup=2, active=5, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+        record_shapes=True)
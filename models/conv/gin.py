@@ -1,14 +1,17 @@
 import torch
 from torch_geometric.nn import MessagePassing
+from torch_sparse import matmul
 import torch.nn.functional as F
-from ogb.graphproppred.mol_encoder import AtomEncoder,BondEncoder
+from models.utils import get_edge_encoder
 
 
 ### GIN convolution along the graph structure
 class GINConv(MessagePassing):
-    def __init__(self, emb_dim, task, flow=None):
+    def __init__(self, emb_dim, task, flow=None, encode_edge_attr=True, has_edge_attr=True):
         '''
             emb_dim (int): node embedding dimensionality
+            encode_edge_attr (bool): whether the convolution encodes the edge_attr with its own edge encoder
+            has_edge_attr (bool): whether the graph has edge features, if not the convolution has no edge encoder
         '''
 
         if flow is None:
@@ -21,33 +24,34 @@ class GINConv(MessagePassing):
                                        torch.nn.ReLU(),
                                        torch.nn.Linear(2*emb_dim, emb_dim))
         self.eps = torch.nn.Parameter(torch.Tensor([0]))
-        if task == "mol":
-            self.edge_encoder = BondEncoder(emb_dim=emb_dim)
-        elif task == "ppo":
-            self.edge_encoder = torch.nn.Linear(7, emb_dim)
-        elif task == "code2":
-            self.edge_encoder = torch.nn.Linear(2, emb_dim)
-        else:
-            raise NotImplementedError
+        # Without encode_edge_attr the edge_attr passed to forward is already encoded (e.g. by a shared encoder)
+        self.has_edge_attr = has_edge_attr
+        self.edge_encoder = get_edge_encoder(task, emb_dim) if has_edge_attr and encode_edge_attr else None
 
     def forward(self, x, edge_index, edge_attr=None, masking=False, expander_node_mask=None, update_nodes="original"):
-        if edge_attr is not None:
-            edge_embedding = self.edge_encoder(edge_attr)
+        if self.has_edge_attr and edge_attr is not None:
+            edge_embedding = self.edge_encoder(edge_attr) if self.edge_encoder is not None else edge_attr
         else:
             edge_embedding = None
 
         # set expander_node_feature to 0-vector
         if masking:
-            x = x * expander_node_mask
+            x = x.masked_fill(~expander_node_mask, 0.)
 
-        out = self.mlp((1 + self.eps) * x + self.propagate(edge_index, x=x, edge_attr=edge_embedding))
+        # (1 + eps) * x + aggregated messages, in a single fused multiply-add
+        out = self.mlp(torch.addcmul(self.propagate(edge_index, x=x, edge_attr=edge_embedding), 1 + self.eps, x))
 
+        if expander_node_mask is None:
+            # Without an expander graph all nodes are updated
+            return out
+
+        # expander_node_mask is a [num_nodes, 1] bool tensor, True for the original nodes
         if update_nodes == "expander":
             # Don't update original nodes on left -> right
-            out = (1 - expander_node_mask) * out + expander_node_mask * x
+            out = torch.where(expander_node_mask, x, out)
         elif update_nodes == "original":
             # Don't update hyperedge nodes on right -> left
-            out = expander_node_mask * out + (1 - expander_node_mask) * x
+            out = torch.where(expander_node_mask, out, x)
 
         return out
 
@@ -57,6 +61,11 @@ class GINConv(MessagePassing):
         else:
             return F.relu(x_j)
 
+    def message_and_aggregate(self, adj_t, x):
+        # Only used when propagating over a SparseTensor, which carries no edge features (the expander graph), so the
+        # relu of the messages can be applied once per node before aggregating
+        return matmul(adj_t, F.relu(x), reduce=self.aggr)
+
     def update(self, aggr_out):
         return aggr_out
 
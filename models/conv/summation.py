@@ -1,5 +1,6 @@
 import torch.nn as nn
 from torch_geometric.nn import MessagePassing
+from torch_sparse import matmul
 
 
 class SumConv(MessagePassing):
@@ -17,6 +18,9 @@ class SumConv(MessagePassing):
     def message(self, x_j):
         return x_j
 
+    def message_and_aggregate(self, adj_t, x):
+        return matmul(adj_t, x, reduce=self.aggr)
+
     def update(self, aggr_out):
         return aggr_out
 
@@ -1,11 +1,48 @@
 import torch
 import torch.nn.functional as F
 import torch_scatter
+from torch_sparse import SparseTensor
 from torch_geometric.nn import global_add_pool, global_mean_pool, global_max_pool, GlobalAttention, Set2Set
 from ogb.graphproppred.mol_encoder import AtomEncoder, BondEncoder
 from models.conv.gcn import GCNConv
 from models.conv.gin import GINConv
 from models.conv.summation import SumConv
+from models.utils import get_edge_encoder
+
+
+def norm_act(h, weight, bias, running_mean, running_var, training, momentum, eps, drop_ratio, act):
+    '''
+        Batch norm -> (relu) -> dropout applied after each convolution. It only takes tensors and constants, so a
+        compiled version is shared by all layers instead of being recompiled for every batch norm module.
+    '''
+    h = F.batch_norm(h, running_mean, running_var, weight, bias, training, momentum, eps)
+    if act:
+        h = F.relu(h)
+    return F.dropout(h, drop_ratio, training=training)
+
+
+class BatchNormAct(torch.nn.BatchNorm1d):
+    """
+    BatchNorm1d followed by (relu) and dropout. It has the parameters and buffers of BatchNorm1d, so the state_dict
+    keys of the models are unchanged.
+    """
+
+    def __init__(self, num_features, drop_ratio, compile_norm_act=False):
+        '''
+            drop_ratio (float): dropout ratio
+            compile_norm_act (bool): whether to compile norm_act with torch.compile (requires PyTorch >= 2.0)
+        '''
+        super(BatchNormAct, self).__init__(num_features)
+        self.drop_ratio = drop_ratio
+        # Graphs differ in their number of nodes, so compile for dynamic shapes to avoid recompiling
+        self.norm_act = torch.compile(norm_act, dynamic=True) if compile_norm_act else norm_act
+
+    def forward(self, h, act=True):
+        # Counted outside norm_act, F.batch_norm doesn't update it
+        if self.training:
+            self.num_batches_tracked.add_(1)
+        return self.norm_act(h, self.weight, self.bias, self.running_mean, self.running_var, self.training,
+                             self.momentum, self.eps, self.drop_ratio, act)
 
 
 ### GNN to generate node embedding
@@ -16,10 +53,12 @@ class GNN_node(torch.nn.Module):
     """
 
     def __init__(self, num_layer, emb_dim, task, node_encoder=None, drop_ratio=0.5, JK="last", residual=False,
-                 gnn_type='gin'):
+                 gnn_type='gin', compile_norm_act=False, share_edge_encoder=False):
         '''
             emb_dim (int): node embedding dimensionality
             num_layer (int): number of GNN message passing layers
+            compile_norm_act (bool): whether to compile norm_act with torch.compile (requires PyTorch >= 2.0)
+            share_edge_encoder (bool): whether all layers share one edge encoder, applied once per forward
         '''
 
         super(GNN_node, self).__init__()
@@ -41,19 +80,22 @@ class GNN_node(torch.nn.Module):
             assert (node_encoder is not None)
             self.node_encoder = node_encoder
 
+        # With a shared edge encoder the edge features are encoded once, instead of in every convolution
+        self.edge_encoder = get_edge_encoder(task, emb_dim) if share_edge_encoder else None
+
         ###List of GNNs
         self.convs = torch.nn.ModuleList()
         self.batch_norms = torch.nn.ModuleList()
 
         for layer in range(num_layer):
             if gnn_type == 'gin':
-                self.convs.append(GINConv(emb_dim, task))
+                self.convs.append(GINConv(emb_dim, task, encode_edge_attr=not share_edge_encoder))
             elif gnn_type == 'gcn':
-                self.convs.append(GCNConv(emb_dim, task))
+                self.convs.append(GCNConv(emb_dim, task, encode_edge_attr=not share_edge_encoder))
             else:
                 raise ValueError('Undefined GNN type called {}'.format(gnn_type))
 
-            self.batch_norms.append(torch.nn.BatchNorm1d(emb_dim))
+            self.batch_norms.append(BatchNormAct(emb_dim, drop_ratio, compile_norm_act))
 
     def forward(self, batched_data):
         ### computing input node embedding
@@ -64,23 +106,23 @@ class GNN_node(torch.nn.Module):
             h = self.node_encoder(x, node_depth.view(-1, ))
         else:
             x, edge_index, edge_attr, batch = batched_data.x, batched_data.edge_index, batched_data.edge_attr, batched_data.batch
-            h = self.node_encoder(x)
+            if self.task == "ppa":
+                # All ppa nodes share the same input embedding, so it is broadcast instead of looked up per node
+                h = self.node_encoder.weight.expand(batched_data.num_nodes, -1)
+            else:
+                h = self.node_encoder(x)
+
+        if self.edge_encoder is not None:
+            edge_attr = self.edge_encoder(edge_attr)
 
         h_list = [h]
-        device = torch.device("cuda:0") if torch.cuda.is_available() else torch.device("cpu")
-        expander_node_mask = torch.ones((x.shape[0], h_list[-1].shape[1]), device=device)
         for layer in range(self.num_layer):
             # masking, expander_node_mask, update_nodes)
             h = self.convs[layer](h_list[layer], edge_index, edge_attr,
-                                  masking=False, expander_node_mask=expander_node_mask,
+                                  masking=False, expander_node_mask=None,
                                   update_nodes="original")
-            h = self.batch_norms[layer](h)
-
-            if layer == self.num_layer - 1:
-                # remove relu for the last layer
-                h = F.dropout(h, self.drop_ratio, training=self.training)
-            else:
-                h = F.dropout(F.relu(h), self.drop_ratio, training=self.training)
+            # remove relu for the last layer
+            h = self.batch_norms[layer](h, act=layer != self.num_layer - 1)
 
             if self.residual:
                 h += h_list[layer]
@@ -91,9 +133,7 @@ class GNN_node(torch.nn.Module):
         if self.JK == "last":
             node_representation = h_list[-1]
         elif self.JK == "sum":
-            node_representation = 0
-            for layer in range(self.num_layer + 1):
-                node_representation += h_list[layer]
+            node_representation = torch.stack(h_list, dim=0).sum(dim=0)
 
         return node_representation
 
@@ -106,10 +146,12 @@ class GNN_node_expander(torch.nn.Module):
 
     def __init__(self, num_layer, emb_dim, task, node_encoder=None, drop_ratio=0.5, JK="last", residual=False,
                  gnn_type='gin',
-                 expander_edge_handling="learn-features"):
+                 expander_edge_handling="learn-features", compile_norm_act=False, share_edge_encoder=False):
         '''
             emb_dim (int): node embedding dimensionality
             num_layer (int): number of GNN message passing layers
+            compile_norm_act (bool): whether to compile norm_act with torch.compile (requires PyTorch >= 2.0)
+            share_edge_encoder (bool): whether all layers share one edge encoder, applied once per forward
         '''
 
         super(GNN_node_expander, self).__init__()
@@ -119,6 +161,7 @@ class GNN_node_expander(torch.nn.Module):
         self.task = task
         ### add residual connection or not
         self.residual = residual
+        self.gnn_type = gnn_type
         self.expander_edge_handling = expander_edge_handling
 
         if self.num_layer < 2:
@@ -132,6 +175,9 @@ class GNN_node_expander(torch.nn.Module):
             assert (node_encoder is not None)
             self.node_encoder = node_encoder
 
+        # With a shared edge encoder the edge features are encoded once, instead of in every convolution
+        self.edge_encoder = get_edge_encoder(task, emb_dim) if share_edge_encoder else None
+
         ###List of GNNs
         self.convs = torch.nn.ModuleList()
         self.batch_norms = torch.nn.ModuleList()
@@ -143,39 +189,39 @@ class GNN_node_expander(torch.nn.Module):
 
         for layer in range(num_layer):
             if gnn_type == 'gin':
-                self.convs.append(GINConv(emb_dim, task))
+                self.convs.append(GINConv(emb_dim, task, encode_edge_attr=not share_edge_encoder))
                 if layer != num_layer - 1:
                     if self.expander_edge_handling not in ["summation", "summation-mlp"]:
-                        self.expander_left_convs.append(GINConv(emb_dim, task, flow="source_to_target"))
-                    self.expander_right_convs.append(GINConv(emb_dim, task, flow="source_to_target"))
+                        self.expander_left_convs.append(GINConv(emb_dim, task, flow="source_to_target",
+                                                                has_edge_attr=False))
+                    self.expander_right_convs.append(GINConv(emb_dim, task, flow="source_to_target",
+                                                             has_edge_attr=False))
             elif gnn_type == 'gcn':
-                self.convs.append(GCNConv(emb_dim, task))
+                self.convs.append(GCNConv(emb_dim, task, encode_edge_attr=not share_edge_encoder))
                 if layer != num_layer - 1:
                     if self.expander_edge_handling not in ["summation", "summation-mlp"]:
-                        self.expander_left_convs.append(GCNConv(emb_dim, task, flow="source_to_target"))
-                    self.expander_right_convs.append(GCNConv(emb_dim, task, flow="source_to_target"))
+                        self.expander_left_convs.append(GCNConv(emb_dim, task, flow="source_to_target",
+                                                                has_edge_attr=False))
+                    self.expander_right_convs.append(GCNConv(emb_dim, task, flow="source_to_target",
+                                                             has_edge_attr=False))
             else:
                 raise ValueError('Undefined GNN type called {}'.format(gnn_type))
 
-            self.batch_norms.append(torch.nn.BatchNorm1d(emb_dim))
+            self.batch_norms.append(BatchNormAct(emb_dim, drop_ratio, compile_norm_act))
 
             if layer != num_layer - 1:
                 if self.expander_edge_handling in ["summation", "summation-mlp"]:
                     self.summation.append(
                         SumConv(emb_dim, mlp=True if self.expander_edge_handling == "summation-mlp" else False))
 
-                self.expander_left_batch_norms.append(torch.nn.BatchNorm1d(emb_dim))
-                self.expander_right_batch_norms.append(torch.nn.BatchNorm1d(emb_dim))
+                self.expander_left_batch_norms.append(BatchNormAct(emb_dim, drop_ratio, compile_norm_act))
+                self.expander_right_batch_norms.append(BatchNormAct(emb_dim, drop_ratio, compile_norm_act))
 
     def propagate(self, conv, bn, h, edge_index, edge_attr=None, expander_node_mask=None, no_act=False, masking=False,
                   update_nodes="original"):
         h_residual = h
         h = conv(h, edge_index, edge_attr, masking, expander_node_mask, update_nodes)
-        h = bn(h)
-        if no_act:
-            h = F.dropout(h, self.drop_ratio, training=self.training)
-        else:
-            h = F.dropout(F.relu(h), self.drop_ratio, training=self.training)
+        h = bn(h, act=not no_act)
         if self.residual:
             h += h_residual
         return h
@@ -192,12 +238,39 @@ class GNN_node_expander(torch.nn.Module):
             x, edge_index, edge_attr, batch, expander_edge_index, expander_node_mask, num_nodes = \
                 batched_data.x, batched_data.edge_index, batched_data.edge_attr, batched_data.batch, \
                     batched_data.expander_edge_index, batched_data.expander_node_mask, batched_data.num_nodes
-            h = self.node_encoder(x)
+            if self.task == "ppa":
+                # All ppa nodes share the same input embedding, so it is broadcast instead of looked up per node
+                h = self.node_encoder.weight.expand(num_nodes, -1)
+            else:
+                h = self.node_encoder(x)
+
+        # Computed once per forward as a [num_nodes, 1] bool tensor, which broadcasts over the features in every layer
+        expander_node_mask = expander_node_mask.bool().unsqueeze(dim=-1)
+        h = h.masked_fill(~expander_node_mask, 0.)
+        # The reversed expander edges are added by the expander graph generation, datasets processed before that was
+        # added don't have them
+        reverse_expander_edge_index = getattr(batched_data, 'expander_edge_index_rev', None)
+        if reverse_expander_edge_index is None:
+            reverse_expander_edge_index = expander_edge_index[[1, 0]]
+
+        # The expander graph has no edge features, so the summation and GIN convolutions on it aggregate with a sparse
+        # matrix multiplication. The (transposed) adjacency matrices are built once and reused by every layer.
+        summation = self.expander_edge_handling in ["summation", "summation-mlp"]
+        expander_adj_t = None
+        if self.gnn_type == 'gin' or summation:
+            expander_adj_t = SparseTensor(row=expander_edge_index[1], col=expander_edge_index[0],
+                                          sparse_sizes=(num_nodes, num_nodes))
+        if self.gnn_type == 'gin':
+            reverse_expander_adj_t = SparseTensor(row=reverse_expander_edge_index[1], col=reverse_expander_edge_index[0],
+                                                  sparse_sizes=(num_nodes, num_nodes))
+            expander_edges, reverse_expander_edges = expander_adj_t, reverse_expander_adj_t
+        else:
+            # GCNConv computes its normalisation from the edge_index
+            expander_edges, reverse_expander_edges = expander_edge_index, reverse_expander_edge_index
+
+        if self.edge_encoder is not None:
+            edge_attr = self.edge_encoder(edge_attr)
 
-        expander_node_mask = expander_node_mask.unsqueeze(dim=-1)
-        expander_node_mask = expander_node_mask.expand(expander_node_mask.shape[0],
-                                                       h.shape[1])
-        h = h * expander_node_mask
         h_list = [h]
         for layer in range(self.num_layer):
             # Propagation on the original graph
@@ -214,10 +287,10 @@ class GNN_node_expander(torch.nn.Module):
             # from left to right. We don't do this in
             # the final layer.
             if layer != self.num_layer - 1:
-                if self.expander_edge_handling in ["summation", "summation-mlp"]:
-                    h = h * expander_node_mask
-                    h_edge = self.summation[layer](h, expander_edge_index)
-                    h = h + h_edge * (1 - expander_node_mask)
+                if summation:
+                    h = h.masked_fill(~expander_node_mask, 0.)
+                    h_edge = self.summation[layer](h, expander_adj_t)
+                    h = torch.where(expander_node_mask, h, h_edge)
                 else:
                     if self.expander_edge_handling == "masking":
                         masking = True
@@ -225,16 +298,15 @@ class GNN_node_expander(torch.nn.Module):
                         masking = False
                     h = self.propagate(self.expander_left_convs[layer],
                                        self.expander_left_batch_norms[layer],
-                                       h, expander_edge_index,
+                                       h, expander_edges,
                                        masking=masking,
                                        expander_node_mask=expander_node_mask,
                                        update_nodes="expander")
 
                 # from right to left
-                reverse_expander_edge_index = expander_edge_index[[1, 0]]
                 h = self.propagate(self.expander_right_convs[layer],
                                    self.expander_right_batch_norms[layer],
-                                   h, reverse_expander_edge_index, masking=False,
+                                   h, reverse_expander_edges, masking=False,
                                    expander_node_mask=expander_node_mask, update_nodes="original")
 
             # TODO: (can have other options) now only saves h at the end of three propagations
@@ -244,9 +316,7 @@ class GNN_node_expander(torch.nn.Module):
         if self.JK == "last":
             node_representation = h_list[-1]
         elif self.JK == "sum":
-            node_representation = 0
-            for layer in range(self.num_layer + 1):
-                node_representation += h_list[layer]
+            node_representation = torch.stack(h_list, dim=0).sum(dim=0)
 
         return node_representation
 
@@ -255,9 +325,12 @@ class GNN(torch.nn.Module):
 
     def __init__(self, task, num_class, max_seq_len=None, node_encoder=None, num_layer=5, emb_dim=300,
                  gnn_type='gin', residual=False, drop_ratio=0.5, JK="last", graph_pooling="mean",
-                 expander=False, expander_edge_handling="learn-features"):
+                 expander=False, expander_edge_handling="learn-features", compile_norm_act=False,
+                 share_edge_encoder=False):
         '''
             num_tasks (int): number of labels to be predicted
+            compile_norm_act (bool): whether to compile the batch norm, relu and dropout after each convolution
+            share_edge_encoder (bool): whether the convolutions on the original graph share one edge encoder
             TODO: virtual_node (bool): whether to add virtual node or not
         '''
 
@@ -281,11 +354,14 @@ class GNN(torch.nn.Module):
         ### GNN to generate node embeddings
         if not expander:
             self.gnn_node = GNN_node(num_layer, emb_dim, task=task, node_encoder=node_encoder, JK=JK,
-                                     drop_ratio=drop_ratio, residual=residual, gnn_type=gnn_type)
+                                     drop_ratio=drop_ratio, residual=residual, gnn_type=gnn_type,
+                                     compile_norm_act=compile_norm_act, share_edge_encoder=share_edge_encoder)
         else:
             self.gnn_node = GNN_node_expander(num_layer, emb_dim, task=task, node_encoder=node_encoder, JK=JK,
                                               drop_ratio=drop_ratio, residual=residual,
-                                              gnn_type=gnn_type, expander_edge_handling=expander_edge_handling)
+                                              gnn_type=gnn_type, expander_edge_handling=expander_edge_handling,
+                                              compile_norm_act=compile_norm_act,
+                                              share_edge_encoder=share_edge_encoder)
 
         ### Pooling function to generate whole-graph embeddings
         if self.graph_pooling == "sum":
@@ -322,12 +398,9 @@ class GNN(torch.nn.Module):
         h_node = self.gnn_node(batched_data)
 
         if self.expander:
-            # Replace batch[i] to -1 where expander_node_mask indicates it is an expander_edge_node
-            # +1 due to scatter function requires indices to be non-negative
-            batch = torch.where(batched_data.expander_node_mask > 0,
-                                batched_data.batch, -1) + 1
-            # Slice off h_graph[0] which was the aggregation of all expander_edge_node
-            h_graph = self.pool(h_node, batch)[1:, :]
+            # Only pool the original graph nodes, the expander_edge_nodes are left out of the graph embedding
+            original_node_mask = batched_data.expander_node_mask.bool()
+            h_graph = self.pool(h_node[original_node_mask], batched_data.batch[original_node_mask])
         else:
             h_graph = self.pool(h_node, batched_data.batch)
 
@@ -4,6 +4,7 @@ import numpy as np
 import torch
 import random
 from distutils.util import strtobool
+from ogb.graphproppred.mol_encoder import BondEncoder
 
 
 class ASTNodeEncoder(torch.nn.Module):
@@ -29,10 +30,29 @@ class ASTNodeEncoder(torch.nn.Module):
         return self.type_encoder(x[:, 0]) + self.attribute_encoder(x[:, 1]) + self.depth_encoder(depth)
 
 
+def get_edge_encoder(task, emb_dim):
+    '''
+        Input:
+            task: task the edge features belong to
+            emb_dim: edge embedding dimensionality
+        Output:
+            module mapping the task's edge features (edge_attr) to emb_dim-dimensional vectors
+    '''
+
+    if task == "mol":
+        return BondEncoder(emb_dim=emb_dim)
+    elif task == "ppa":
+        return torch.nn.Linear(7, emb_dim)
+    elif task == "code2":
+        return torch.nn.Linear(2, emb_dim)
+    else:
+        raise NotImplementedError
+
+
 def get_vocab_mapping(seq_list, num_vocab):
     '''
         Input:
-            seq_list: a list of sequences
+            seq_list: an iterable of sequences
             num_vocab: vocabulary size
         Output:
             vocab2idx:
@@ -183,6 +203,23 @@ def decode_arr_to_seq(arr, idx2vocab):
     return list(map(lambda x: idx2vocab[x], clippted_arr.cpu()))
 
 
+def decode_mat_to_seqs(mat, idx2vocab_arr):
+    '''
+        Input:
+            mat: torch 2d array of predicted y_arr, one row per graph
+            idx2vocab_arr: numpy object array that maps idx to actual vocabulary
+        Output: a list of sequences of words, equivalent to decode_arr_to_seq applied to every row.
+    '''
+
+    mat = np.asarray(mat)
+    is_eos = mat == len(idx2vocab_arr) - 1  # find the position of __EOS__ (the last vocab in idx2vocab)
+    # Clip each row at its smallest __EOS__, or keep the whole row if there is none
+    seq_lens = np.where(is_eos.any(axis=1), is_eos.argmax(axis=1), mat.shape[1])
+    word_mat = idx2vocab_arr[mat]
+
+    return [word_row[:seq_len].tolist() for word_row, seq_len in zip(word_mat, seq_lens)]
+
+
 def str2bool(x):
     if type(x) == bool:
         return x
@@ -201,6 +238,15 @@ def set_seed(seed):
     random.seed(seed)
 
 
+def set_backend_flags(deterministic=False):
+    # cuDNN autotuning and TF32 tensor core matmuls/convolutions are faster, but give up bitwise reproducibility
+    torch.backends.cudnn.benchmark = not deterministic
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cuda.matmul.allow_tf32 = not deterministic
+    torch.backends.cudnn.allow_tf32 = not deterministic
+    torch.set_float32_matmul_precision('highest' if deterministic else 'high')
+
+
 def test():
     seq_list = [['a', 'b'], ['a', 'b', 'c', 'df', 'f', '2edea', 'a'], ['eraea', 'a', 'c'], ['d'],
                 ['4rq4f', 'f', 'a', 'a', 'g']]
@@ -220,6 +266,7 @@ def test():
         # arr[2] = vocab2idx['__EOS__']
         print(arr)
         seq_dec = decode_arr_to_seq(arr, idx2vocab)
+        assert (seq_dec == decode_mat_to_seqs(arr.view(1, -1), np.array(idx2vocab, dtype=object))[0])
 
         print(arr)
         print(seq_dec)